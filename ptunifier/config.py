@@ -66,6 +66,7 @@ def config():
     mim_decoder_num_heads = 6
     norm_pix_loss = True
     mim_layer = -1
+    mim_bf16_loss = False  # compute the MIM loss in bf16 on GPUs that support it (needs torch>=1.10)
 
     # Optimizer Setting
     optim_type = "adamw"
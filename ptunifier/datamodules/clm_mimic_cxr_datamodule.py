@@ -1,18 +1,24 @@
+import functools
+
 from .base_datamodule import BaseDataModule
 from ..datasets import CLMMIMICCXRDataset
 
 
 class CLMMIMICCXRDataModule(BaseDataModule):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, _config):
+        super().__init__(_config)
+        self.clm_text_column_name = "findings" if _config["vision_only"] else "impression"
+        self.clm_max_text_len = _config["clm_max_text_len"]
 
     @property
     def dataset_cls(self):
-        return CLMMIMICCXRDataset
+        return functools.partial(CLMMIMICCXRDataset,
+                                 clm_text_column_name=self.clm_text_column_name,
+                                 clm_max_text_len=self.clm_max_text_len)
 
     @property
     def dataset_cls_no_false(self):
-        return CLMMIMICCXRDataset
+        return self.dataset_cls
 
     @property
     def dataset_name(self):
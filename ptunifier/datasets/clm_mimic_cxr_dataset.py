@@ -8,9 +8,13 @@ def get_mimic_cxr_tokenizer(path):
 
 
 class CLMMIMICCXRDataset(BaseDataset):
-    def __init__(self, *args, split="", **kwargs):
+    def __init__(self, *args, split="", clm_text_column_name="", clm_max_text_len=0, **kwargs):
         assert split in ["train", "val", "test"]
+        assert clm_text_column_name in ["findings", "impression"]
+        assert clm_max_text_len > 0
         self.split = split
+        self.clm_text_column_name = clm_text_column_name
+        self.clm_max_text_len = clm_max_text_len
 
         if split == "train":
             names = ["clm_mimic_cxr_train"]
@@ -42,4 +46,11 @@ class CLMMIMICCXRDataset(BaseDataset):
         dict_batch["findings"] = [sample["findings"].lower() for sample in batch]
         dict_batch["impression"] = [sample["impression"].lower() for sample in batch]
 
+        # Tokenize the generation targets here so that it runs in the dataloader workers
+        text_key = self.clm_text_column_name
+        encodings = self.tokenizer(dict_batch[text_key], max_length=self.clm_max_text_len, truncation=True,
+                                   padding=True, return_token_type_ids=False, return_tensors="pt")
+        dict_batch[f"{text_key}_ids"] = encodings["input_ids"]
+        dict_batch[f"{text_key}_masks"] = encodings["attention_mask"]
+
         return dict_batch
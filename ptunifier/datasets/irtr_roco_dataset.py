@@ -1,3 +1,5 @@
+import torch
+
 from .base_dataset import BaseDataset
 
 
@@ -19,3 +21,21 @@ class IRTRROCODataset(BaseDataset):
 
     def __getitem__(self, index):
         return self.get_suite(index)
+
+    def collate(self, batch, mlm_collator):
+        dict_batch = super(IRTRROCODataset, self).collate(batch, mlm_collator)
+
+        # Stack the true (index 0) and the false texts as [bs, draw_false_text + 1, max_text_len]
+        # (the no-false recall datasets draw none and keep only their plain text_* keys)
+        if self.draw_false_text > 0 and "text_ids" in dict_batch:
+            for suffix in ["ids", "masks", "labels"]:
+                dict_batch[f"irtr_text_{suffix}"] = torch.stack(
+                    [dict_batch[f"text_{suffix}"]] +
+                    [dict_batch[f"false_text_{i}_{suffix}"] for i in range(self.draw_false_text)], dim=1)
+
+            # The per-false-text entries are only read through the stacked tensors, so do not keep both copies
+            for i in range(self.draw_false_text):
+                for suffix in ["", "_ids", "_masks", "_labels", "_ids_mlm", "_labels_mlm"]:
+                    dict_batch.pop(f"false_text_{i}{suffix}")
+
+        return dict_batch
@@ -1,4 +1,6 @@
+import concurrent.futures
 import functools
+import itertools
 
 import torch
 import torch.nn.functional as F
@@ -6,65 +8,69 @@ import tqdm
 from einops import rearrange
 from torch.utils.data.distributed import DistributedSampler
 
-from ptunifier.models.utils.dist_utils import all_gather
+from ptunifier.models.utils.dist_utils import all_gather_tensor, get_rank
 
 
-def compute_mlm(pl_module, batch):
-    infer = pl_module.infer(batch, mask_text=True, mask_image=False)
-    mlm_logits = pl_module.mlm_head(infer["multi_modal_text_feats"])
-    mlm_labels = infer["text_labels"]
+def pinned_to_device(tensor, device):
+    # page-locked host memory lets the copy run asynchronously w.r.t. the host
+    if device.type == "cuda":
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
 
-    mlm_loss = F.cross_entropy(
-        mlm_logits.view(-1, pl_module.hparams.config["vocab_size"]),
-        mlm_labels.view(-1),
-        ignore_index=-100,
-    )
 
-    ret = {
-        "mlm_loss": mlm_loss,
-        "mlm_logits": mlm_logits,
-        "mlm_labels": mlm_labels,
-        "mlm_ids": infer["text_ids"],
-    }
+@functools.lru_cache()
+def bf16_supported():
+    return torch.cuda.is_available() and getattr(torch.cuda, "is_bf16_supported", lambda: False)()
 
-    phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_mlm_loss")(ret["mlm_loss"])
-    acc = getattr(pl_module, f"{phase}_mlm_accuracy")(ret["mlm_logits"], ret["mlm_labels"])
-    pl_module.log(f"mlm/{phase}/loss", loss)
-    pl_module.log(f"mlm/{phase}/accuracy", acc)
 
-    return ret
+def masked_normed_mse(logits, target, mask, norm_pix_loss, bf16=False):
+    # the loss is memory-bound on the [N, L, D] patches, so optionally run the elementwise part in bf16
+    target_dtype = target.dtype
+    if bf16 and logits.is_cuda and bf16_supported():
+        logits, target = logits.to(torch.bfloat16), target.to(torch.bfloat16)
 
+    if norm_pix_loss:
+        var, mean = torch.var_mean(target, dim=-1, keepdim=True)
+        target = (target - mean) / (var + 1.e-6) ** .5
+
+    loss = (logits - target).square().mean(dim=-1)  # [N, L], mean loss per patch
+    loss = (loss.float() * mask).sum() / mask.sum()  # mean loss on removed patches
+    return loss, target.to(target_dtype)
+
+
+def masked_lm_loss(logits, labels):
+    return F.cross_entropy(logits.view(-1, logits.size(-1)), labels.view(-1), ignore_index=-100)
 
-def compute_umlm(pl_module, batch):
-    infer = pl_module.infer(batch, mask_text=True, mask_image=False, pseudo_vision=True)
-    umlm_logits = pl_module.mlm_head(infer["multi_modal_text_feats"])
-    umlm_labels = infer["text_labels"]
 
-    umlm_loss = F.cross_entropy(
-        umlm_logits.view(-1, pl_module.hparams.config["vocab_size"]),
-        umlm_labels.view(-1),
-        ignore_index=-100,
-    )
+# fuse the loss bodies into few kernels where the compiler is available; the shapes vary with the batch
+if hasattr(torch, "compile"):
+    masked_normed_mse = torch.compile(masked_normed_mse, dynamic=True)
+    masked_lm_loss = torch.compile(masked_lm_loss, dynamic=True)
+
+
+def _compute_mlm_generic(pl_module, batch, *, pseudo_vision, name):
+    infer = pl_module.infer(batch, mask_text=True, mask_image=False, pseudo_vision=pseudo_vision)
+    logits = pl_module.mlm_head(infer["multi_modal_text_feats"])
+    labels = infer["text_labels"]
 
     ret = {
-        "umlm_loss": umlm_loss,
-        "umlm_logits": umlm_logits,
-        "umlm_labels": umlm_labels,
-        "umlm_ids": infer["text_ids"],
+        f"{name}_loss": masked_lm_loss(logits, labels),
+        f"{name}_logits": logits,
+        f"{name}_labels": labels,
+        f"{name}_ids": infer["text_ids"],
     }
 
     phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_umlm_loss")(ret["umlm_loss"])
-    acc = getattr(pl_module, f"{phase}_umlm_accuracy")(ret["umlm_logits"], ret["umlm_labels"])
-    pl_module.log(f"umlm/{phase}/loss", loss)
-    pl_module.log(f"umlm/{phase}/accuracy", acc)
+    loss = pl_module._metrics_by_phase[phase][f"{name}_loss"](ret[f"{name}_loss"])
+    acc = pl_module._metrics_by_phase[phase][f"{name}_accuracy"](ret[f"{name}_logits"], ret[f"{name}_labels"])
+    pl_module.log(f"{name}/{phase}/loss", loss)
+    pl_module.log(f"{name}/{phase}/accuracy", acc)
 
     return ret
 
 
-def compute_mim(pl_module, batch):
-    infer = pl_module.infer(batch, mask_text=False, mask_image=True)
+def _compute_mim_generic(pl_module, batch, *, pseudo_language, name):
+    infer = pl_module.infer(batch, mask_text=False, mask_image=True, pseudo_language=pseudo_language)
 
     if pl_module.hparams.config["mim_layer"] == -1:
         multi_modal_image_feats = infer["multi_modal_image_feats"]
@@ -72,91 +78,55 @@ def compute_mim(pl_module, batch):
         layer_idx = pl_module.hparams.config["mim_layer"]
         multi_modal_image_feats = infer[f"multi_modal_image_feats_{layer_idx}"]
 
-    mim_logits = pl_module.mim_head(multi_modal_image_feats, infer["mim_ids_restore"])
-
-    target = infer["patched_images"]
-    if pl_module.hparams.config["norm_pix_loss"]:
-        mean = target.mean(dim=-1, keepdim=True)
-        var = target.var(dim=-1, keepdim=True)
-        target = (target - mean) / (var + 1.e-6) ** .5
-    mim_labels = target
-    mask = infer["mim_masks"]
-
-    mim_loss = (mim_logits - mim_labels) ** 2
-    mim_loss = mim_loss.mean(dim=-1)  # [N, L], mean loss per patch
-    mim_loss = (mim_loss * mask).sum() / mask.sum()  # mean loss on removed patches
+    logits = pl_module.mim_head(multi_modal_image_feats, infer["mim_ids_restore"])
+    loss, labels = masked_normed_mse(logits, infer["patched_images"], infer["mim_masks"],
+                                     pl_module.hparams.config["norm_pix_loss"],
+                                     pl_module.hparams.config["mim_bf16_loss"])
 
     ret = {
-        "mim_loss": mim_loss,
-        "mim_logits": mim_logits,
-        "mim_labels": mim_labels,
+        f"{name}_loss": loss,
+        f"{name}_logits": logits,
+        f"{name}_labels": labels,
     }
 
     phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_mim_loss")(ret["mim_loss"])
+    loss = pl_module._metrics_by_phase[phase][f"{name}_loss"](ret[f"{name}_loss"])
     acc = -loss
-    pl_module.log(f"mim/{phase}/loss", loss)
-    pl_module.log(f"mim/{phase}/accuracy", acc)
+    pl_module.log(f"{name}/{phase}/loss", loss)
+    pl_module.log(f"{name}/{phase}/accuracy", acc)
 
     return ret
 
 
-def compute_umim(pl_module, batch):
-    infer = pl_module.infer(batch, mask_text=False, mask_image=True, pseudo_language=True)
-
-    if pl_module.hparams.config["mim_layer"] == -1:
-        multi_modal_image_feats = infer["multi_modal_image_feats"]
-    else:
-        layer_idx = pl_module.hparams.config["mim_layer"]
-        multi_modal_image_feats = infer[f"multi_modal_image_feats_{layer_idx}"]
+def compute_mlm(pl_module, batch):
+    return _compute_mlm_generic(pl_module, batch, pseudo_vision=False, name="mlm")
 
-    umim_logits = pl_module.mim_head(multi_modal_image_feats, infer["mim_ids_restore"])
 
-    target = infer["patched_images"]
-    if pl_module.hparams.config["norm_pix_loss"]:
-        mean = target.mean(dim=-1, keepdim=True)
-        var = target.var(dim=-1, keepdim=True)
-        target = (target - mean) / (var + 1.e-6) ** .5
-    umim_labels = target
-    mask = infer["mim_masks"]
+def compute_umlm(pl_module, batch):
+    return _compute_mlm_generic(pl_module, batch, pseudo_vision=True, name="umlm")
 
-    umim_loss = (umim_logits - umim_labels) ** 2
-    umim_loss = umim_loss.mean(dim=-1)  # [N, L], mean loss per patch
-    umim_loss = (umim_loss * mask).sum() / mask.sum()  # mean loss on removed patches
 
-    ret = {
-        "umim_loss": umim_loss,
-        "umim_logits": umim_logits,
-        "umim_labels": umim_labels,
-    }
+def compute_mim(pl_module, batch):
+    return _compute_mim_generic(pl_module, batch, pseudo_language=False, name="mim")
 
-    phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_umim_loss")(ret["umim_loss"])
-    acc = -loss
-    pl_module.log(f"umim/{phase}/loss", loss)
-    pl_module.log(f"umim/{phase}/accuracy", acc)
 
-    return ret
+def compute_umim(pl_module, batch):
+    return _compute_mim_generic(pl_module, batch, pseudo_language=True, name="umim")
 
 
 def compute_itm(pl_module, batch):
     pos_len = len(batch["text"]) // 2
     neg_len = len(batch["text"]) - pos_len
     itm_labels = torch.cat([torch.ones(pos_len), torch.zeros(neg_len)]).to(pl_module.device)
-    itm_labels = itm_labels[torch.randperm(itm_labels.size(0))]
+    itm_labels = itm_labels[torch.randperm(itm_labels.size(0), device=pl_module.device)]
 
+    itm_masks = itm_labels.bool().view(-1, 1, 1, 1)
     itm_images = [
-        torch.stack(
-            [
-                ti if itm_labels[i] == 1 else fi
-                for i, (ti, fi) in enumerate(zip(bti, bfi))
-            ]
-        )
+        torch.where(itm_masks, bti, bfi)
         for bti, bfi in zip(batch["image"], batch["false_image_0"])
     ]
 
-    batch = {k: v for k, v in batch.items()}
-    batch["image"] = itm_images
+    batch = {**batch, "image": itm_images}
 
     infer = pl_module.infer(batch, mask_text=False, mask_image=False)
 
@@ -170,8 +140,8 @@ def compute_itm(pl_module, batch):
     }
 
     phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_itm_loss")(ret["itm_loss"])
-    acc = getattr(pl_module, f"{phase}_itm_accuracy")(ret["itm_logits"], ret["itm_labels"])
+    loss = pl_module._metrics_by_phase[phase]["itm_loss"](ret["itm_loss"])
+    acc = pl_module._metrics_by_phase[phase]["itm_accuracy"](ret["itm_logits"], ret["itm_labels"])
     pl_module.log(f"itm/{phase}/loss", loss)
     pl_module.log(f"itm/{phase}/accuracy", acc)
 
@@ -185,7 +155,8 @@ def compute_itc(pl_module, batch):
     text_feats = pl_module.infer(batch, pseudo_vision=True)["multi_modal_cls_feats"]
     itc_logits_image, itc_logits_text = pl_module.itc_head(image_feats, text_feats)
 
-    itc_labels = torch.arange(itc_logits_image.size(0), device=device)
+    # the logits of the local samples are laid out against the features gathered from all ranks
+    itc_labels = torch.arange(itc_logits_image.size(0), device=device) + get_rank() * itc_logits_image.size(0)
     itc_loss_image = F.cross_entropy(itc_logits_image, itc_labels)
     itc_loss_text = F.cross_entropy(itc_logits_text, itc_labels)
     itc_loss = (itc_loss_image + itc_loss_text) / 2
@@ -198,7 +169,7 @@ def compute_itc(pl_module, batch):
     }
 
     phase = "train" if pl_module.training else "val"
-    loss = getattr(pl_module, f"{phase}_itc_loss")(ret["itc_loss"])
+    loss = pl_module._metrics_by_phase[phase]["itc_loss"](ret["itc_loss"])
     acc = -loss
     pl_module.log(f"itc/{phase}/loss", loss)
     pl_module.log(f"itc/{phase}/accuracy", acc)
@@ -213,11 +184,16 @@ def compute_vqa(pl_module, batch, test=False):
 
     vqa_labels = batch["vqa_labels"]
     vqa_scores = batch["vqa_scores"]
-    vqa_answer_types = torch.tensor(batch["answer_types"], device=pl_module.device)
+    vqa_answer_types = pinned_to_device(torch.as_tensor(batch["answer_types"], dtype=torch.long), pl_module.device)
 
-    for i, (_label, _score) in enumerate(zip(vqa_labels, vqa_scores)):
-        for l, s in zip(_label, _score):
-            vqa_targets[i, l] = s
+    # scatter all (row, label, score) triples in one shot instead of per-element writes
+    vqa_rows = torch.repeat_interleave(torch.arange(len(vqa_labels)),
+                                       torch.tensor([len(_label) for _label in vqa_labels], dtype=torch.long))
+    vqa_cols = torch.tensor(list(itertools.chain.from_iterable(vqa_labels)), dtype=torch.long)
+    vqa_vals = torch.tensor(list(itertools.chain.from_iterable(vqa_scores)), dtype=vqa_targets.dtype)
+    vqa_targets.index_put_((pinned_to_device(vqa_rows, pl_module.device),
+                            pinned_to_device(vqa_cols, pl_module.device)),
+                           pinned_to_device(vqa_vals, pl_module.device))
 
     vqa_loss = (F.binary_cross_entropy_with_logits(vqa_logits, vqa_targets) * vqa_targets.shape[1])
 
@@ -235,8 +211,9 @@ def compute_vqa(pl_module, batch, test=False):
     else:
         phase = "train" if pl_module.training else "val"
 
-    loss = getattr(pl_module, f"{phase}_vqa_loss")(ret["vqa_loss"])
-    score = getattr(pl_module, f"{phase}_vqa_score")(ret["vqa_logits"], ret["vqa_targets"], ret["vqa_answer_types"])
+    loss = pl_module._metrics_by_phase[phase]["vqa_loss"](ret["vqa_loss"])
+    score = pl_module._metrics_by_phase[phase]["vqa_score"](ret["vqa_logits"], ret["vqa_targets"],
+                                                            ret["vqa_answer_types"])
     pl_module.log(f"vqa/{phase}/loss", loss)
     pl_module.log(f"vqa/{phase}/score", score)
 
@@ -263,8 +240,8 @@ def compute_cls(pl_module, batch, test=False):
     else:
         phase = "train" if pl_module.training else "val"
 
-    loss = getattr(pl_module, f"{phase}_cls_loss")(ret["cls_loss"])
-    acc = getattr(pl_module, f"{phase}_cls_accuracy")(ret["cls_logits"], ret["cls_labels"])
+    loss = pl_module._metrics_by_phase[phase]["cls_loss"](ret["cls_loss"])
+    acc = pl_module._metrics_by_phase[phase]["cls_accuracy"](ret["cls_logits"], ret["cls_labels"])
     pl_module.log(f"cls/{phase}/loss", loss)
     pl_module.log(f"cls/{phase}/accuracy", acc)
 
@@ -296,15 +273,25 @@ def compute_mlc(pl_module, batch, test=False):
     else:
         phase = "train" if pl_module.training else "val"
 
-    loss = getattr(pl_module, f"{phase}_mlc_loss")(ret["mlc_loss"])
-    getattr(pl_module, f"{phase}_mlc_aucroc").update(F.sigmoid(ret["mlc_logits"]), ret["mlc_labels"])
-    getattr(pl_module, f"{phase}_mlc_f1").update(F.sigmoid(ret["mlc_logits"]), ret["mlc_labels"])
+    loss = pl_module._metrics_by_phase[phase]["mlc_loss"](ret["mlc_loss"])
+    pl_module._metrics_by_phase[phase]["mlc_aucroc"].update(F.sigmoid(ret["mlc_logits"]), ret["mlc_labels"])
+    pl_module._metrics_by_phase[phase]["mlc_f1"].update(F.sigmoid(ret["mlc_logits"]), ret["mlc_labels"])
 
     pl_module.log(f"mlc/{phase}/loss", loss)
 
     return ret
 
 
+def update_clm_metrics(pl_module, phase, gen_texts, gt_texts):
+    metrics = pl_module._metrics_by_phase[phase]
+    gt_refs = [[text] for text in gt_texts]  # one reference per generated text, built once for all BLEU orders
+    for i in [1, 2, 3, 4]:
+        metrics[f"clm_bleu_{i}"].update(gen_texts, gt_refs)
+    metrics["clm_rouge"].update(gen_texts, gt_texts)
+    metrics["clm_coco_caption"].update(gen_texts, gt_texts)
+    metrics["clm_jb"].update(gen_texts, gt_texts)
+
+
 def compute_clm(pl_module, batch, test=False):
     if test:
         phase = "test"
@@ -318,21 +305,21 @@ def compute_clm(pl_module, batch, test=False):
     encoder_hidden_states = torch.cat([infer["multi_modal_image_feats"], infer["multi_modal_text_feats"]], dim=1)
     encoder_hidden_states = pl_module.clm_proj(encoder_hidden_states)
 
-    texts = batch["findings"] if pl_module.hparams.config["vision_only"] else batch["impression"]
-    texts = [text.lower() for text in texts]  # Lower case the ground truth
+    text_key = "findings" if pl_module.hparams.config["vision_only"] else "impression"
+    texts = batch[text_key]  # Lower cased in the dataset collate
 
-    texts_inputs = pl_module.clm_tokenizer(texts, max_length=pl_module.hparams.config["clm_max_text_len"],
-                                           truncation=True, padding=True, return_token_type_ids=False,
-                                           return_tensors="pt").to(pl_module.device)
+    # tokenized in the dataset collate
+    text_ids = batch[f"{text_key}_ids"].to(pl_module.device, non_blocking=True)
+    text_masks = batch[f"{text_key}_masks"].to(pl_module.device, non_blocking=True)
 
-    outputs = pl_module.clm_head(input_ids=texts_inputs.input_ids,
-                                 attention_mask=texts_inputs.attention_mask,
+    outputs = pl_module.clm_head(input_ids=text_ids,
+                                 attention_mask=text_masks,
                                  encoder_hidden_states=encoder_hidden_states,
                                  use_cache=False)
 
     clm_logits = outputs.logits
     clm_logits = clm_logits[:, :-1, :].contiguous()
-    clm_labels = texts_inputs.input_ids[:, 1:].contiguous()
+    clm_labels = text_ids[:, 1:].contiguous()
     clm_loss = F.cross_entropy(clm_logits.view(-1, clm_logits.size(-1)),
                                clm_labels.view(-1),
                                ignore_index=pl_module.clm_tokenizer.pad_token_id)
@@ -343,26 +330,24 @@ def compute_clm(pl_module, batch, test=False):
         "clm_labels": clm_labels
     }
 
-    loss = getattr(pl_module, f"{phase}_clm_loss")(ret["clm_loss"])
+    loss = pl_module._metrics_by_phase[phase]["clm_loss"](ret["clm_loss"])
     pl_module.log(f"clm/{phase}/loss", loss)
 
     if not phase == "train":
-        bs = encoder_hidden_states.size(0)
-        input_ids = torch.tensor([[pl_module.clm_tokenizer.cls_token_id]] * bs, dtype=torch.long,
-                                 device=pl_module.device)
-
-        # expand for beam search
-        expanded_idx = (
-            torch.arange(input_ids.shape[0], device=pl_module.device).view(-1, 1).repeat(1, pl_module.hparams.config[
-                "clm_num_beams"]).view(-1)
-        )
-        encoder_hidden_states = encoder_hidden_states.index_select(0, expanded_idx)
-
-        gen_texts = pl_module.clm_head.generate(input_ids=input_ids,
-                                                encoder_hidden_states=encoder_hidden_states,
-                                                max_length=pl_module.hparams.config["clm_max_text_len"],
-                                                do_sample=pl_module.hparams.config["clm_do_sample"],
-                                                num_beams=pl_module.hparams.config["clm_num_beams"])
+        with torch.inference_mode():
+            bs = encoder_hidden_states.size(0)
+            input_ids = torch.tensor([[pl_module.clm_tokenizer.cls_token_id]] * bs, dtype=torch.long,
+                                     device=pl_module.device)
+
+            # expand for beam search: [bs, L, D] -> [bs * num_beams, L, D], each sample repeated num_beams times
+            encoder_hidden_states = encoder_hidden_states.repeat_interleave(pl_module.hparams.config["clm_num_beams"],
+                                                                            dim=0)
+
+            gen_texts = pl_module.clm_head.generate(input_ids=input_ids,
+                                                    encoder_hidden_states=encoder_hidden_states,
+                                                    max_length=pl_module.hparams.config["clm_max_text_len"],
+                                                    do_sample=pl_module.hparams.config["clm_do_sample"],
+                                                    num_beams=pl_module.hparams.config["clm_num_beams"])
 
         gen_texts = pl_module.clm_tokenizer.batch_decode(gen_texts, skip_special_tokens=True)
         # Gen Texts can not be empty.
@@ -377,11 +362,7 @@ def compute_clm(pl_module, batch, test=False):
         ret["gen_texts"] = gen_texts
         ret["gt_texts"] = gt_texts
 
-        for i in [1, 2, 3, 4]:
-            getattr(pl_module, f"{phase}_clm_bleu_{i}").update(ret["gen_texts"], [[text] for text in ret["gt_texts"]])
-        getattr(pl_module, f"{phase}_clm_rouge").update(ret["gen_texts"], ret["gt_texts"])
-        getattr(pl_module, f"{phase}_clm_coco_caption").update(ret["gen_texts"], ret["gt_texts"])
-        getattr(pl_module, f"{phase}_clm_jb").update(ret["gen_texts"], ret["gt_texts"])
+        update_clm_metrics(pl_module, phase, ret["gen_texts"], ret["gt_texts"])
 
     return ret
 
@@ -390,20 +371,17 @@ def compute_irtr(pl_module, batch, test=False):
     is_training_phase = pl_module.training
     _bs, _c, _h, _w = batch["image"][0].shape
     false_len = pl_module.hparams.config["draw_false_text"]
-    text_ids = torch.stack([batch[f"false_text_{i}_ids"] for i in range(false_len)], dim=1)
-    text_masks = torch.stack([batch[f"false_text_{i}_masks"] for i in range(false_len)], dim=1)
-    text_labels = torch.stack([batch[f"false_text_{i}_labels"] for i in range(false_len)], dim=1)
-
-    text_ids = torch.cat([batch["text_ids"].unsqueeze(1), text_ids], dim=1)
-    text_masks = torch.cat([batch["text_masks"].unsqueeze(1), text_masks], dim=1)
-    text_labels = torch.cat([batch["text_labels"].unsqueeze(1), text_labels], dim=1)
+    # [bs, false_len + 1, tl] with the true text at index 0, stacked in the dataset collate
+    text_ids = batch["irtr_text_ids"]
+    text_masks = batch["irtr_text_masks"]
+    text_labels = batch["irtr_text_labels"]
     images = batch["image"][0].unsqueeze(1).expand(_bs, false_len + 1, _c, _h, _w)
 
     batch_infer = {
         "image": [rearrange(images, "bs fs c h w -> (bs fs) c h w")],
-        "text_ids": rearrange(text_ids, "bs fs tl -> (bs fs) tl"),
-        "text_masks": rearrange(text_masks, "bs fs tl -> (bs fs) tl"),
-        "text_labels": rearrange(text_labels, "bs fs tl -> (bs fs) tl"),
+        "text_ids": text_ids.view(_bs * (false_len + 1), -1),
+        "text_masks": text_masks.view(_bs * (false_len + 1), -1),
+        "text_labels": text_labels.view(_bs * (false_len + 1), -1),
     }
 
     infer = pl_module.infer(batch_infer)
@@ -420,7 +398,7 @@ def compute_irtr(pl_module, batch, test=False):
     else:
         phase = "train" if pl_module.training else "val"
 
-    irtr_loss = getattr(pl_module, f"{phase}_irtr_loss")(ret["irtr_loss"])
+    irtr_loss = pl_module._metrics_by_phase[phase]["irtr_loss"](ret["irtr_loss"])
     pl_module.log(f"irtr/{phase}/irtr_loss", irtr_loss)
 
     return ret
@@ -443,88 +421,107 @@ def compute_irtr_recall(pl_module):
     dist_sampler = DistributedSampler(image_dset, shuffle=False)
     image_loader = torch.utils.data.DataLoader(
         image_dset,
-        batch_size=1,
+        batch_size=64,
         num_workers=pl_module.hparams.config["num_workers"],
         sampler=dist_sampler,
         pin_memory=True,
         collate_fn=functools.partial(image_dset.collate,
                                      mlm_collator=pl_module.trainer.datamodule.dms[0].mlm_collator, ), )
 
-    # TODO: speed up the process by caching text/image features
-    text_preload = list()
-    for _b in tqdm.tqdm(text_loader, desc="text prefetch loop"):
-        # == Begin: Add New Keys ==
-        batch_text_preload = {
-            "text_ids": _b["text_ids"].to(pl_module.device),
-            "text_masks": _b["text_masks"].to(pl_module.device),
-            "text_labels": _b["text_labels"].to(pl_module.device),
-            "img_index": _b["img_index"],
-        }
-        text_preload.append(batch_text_preload)
-        # == End  : Add New Keys ==
+    def set_thread_device():
+        # new threads start on CUDA device 0; the pin-memory thread of the loader and the copies must use ours
+        if pl_module.device.type == "cuda":
+            torch.cuda.set_device(pl_module.device)
+
+    # Uni-modal features are computed once; only the fusion layers run per (image, text) pair
+    def preload_texts():
+        set_thread_device()
+        text_preload = list()
+        for _b in tqdm.tqdm(text_loader, desc="text prefetch loop"):
+            # == Begin: Add New Keys ==
+            batch_text_preload = {
+                "text_ids": _b["text_ids"].to(pl_module.device, non_blocking=True),
+                "text_masks": _b["text_masks"].to(pl_module.device, non_blocking=True),
+                "text_labels": _b["text_labels"].to(pl_module.device, non_blocking=True),
+                "img_index": _b["img_index"],
+            }
+            text_preload.append(batch_text_preload)
+            # == End  : Add New Keys ==
+        return text_preload
+
+    def preload_images():
+        set_thread_device()
+        image_preload = list()
+        for _b in tqdm.tqdm(image_loader, desc="image prefetch loop"):
+            image_preload.append((_b['image'][0], _b["img_index"]))
+        return image_preload
+
+    # Both prefetch loops are I/O bound, so run them concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        text_future = executor.submit(preload_texts)
+        image_future = executor.submit(preload_images)
+        text_preload = text_future.result()
+        image_preload = image_future.result()
 
     tiids = list()
     for pre in text_preload:
         tiids += pre["img_index"]
     tiids = torch.tensor(tiids)
 
-    image_preload = list()
-    for _b in tqdm.tqdm(image_loader, desc="image prefetch loop"):
-        image_preload.append((_b['image'][0], _b["img_index"][0]))
+    text_feats = list()
+    for txt_batch in tqdm.tqdm(text_preload, desc="text encoding loop"):
+        with torch.cuda.amp.autocast():
+            text_feats.append(pl_module.infer_uni_modal_text(txt_batch["text_ids"], txt_batch["text_masks"]))
 
     rank_scores = list()
     rank_iids = list()
 
-    for img_batch in tqdm.tqdm(image_preload, desc="rank loop"):
-        _im, _iid = img_batch
+    # Images are encoded one loader batch at a time, so only one batch of image features is kept on the device
+    for im_batch, iid_batch in tqdm.tqdm(image_preload, desc="rank loop"):
+        with torch.cuda.amp.autocast():
+            im_batch_feats, im_batch_masks = pl_module.infer_uni_modal_image(
+                im_batch.to(pl_module.device, non_blocking=True))
 
-        img_batch_score = list()
-        for txt_batch in text_preload:
-            fblen = len(txt_batch["text_ids"])
-            im = _im.repeat(fblen, 1, 1, 1).to(device=txt_batch['text_ids'].device)
+        for i, _iid in enumerate(iid_batch):
+            img_batch_score = list()
+            for _txt_feats, _txt_masks in text_feats:
+                fblen = len(_txt_feats)
+                im_feats = im_batch_feats[i:i + 1].expand(fblen, -1, -1)
+                im_masks = im_batch_masks[i:i + 1].expand(fblen, -1, -1, -1)
 
-            with torch.cuda.amp.autocast():
-                # == Begin: Add New Keys ==
-                batch_infer = {
-                    "text_ids": txt_batch["text_ids"],
-                    "text_masks": txt_batch["text_masks"],
-                    "text_labels": txt_batch["text_labels"],
-                }
-                score = pl_module.irtr_head(pl_module.infer(batch_infer, img=im, )["multi_modal_cls_feats"])[:, 0]
-                # == End  : Add New Keys ==
+                with torch.cuda.amp.autocast():
+                    infer = pl_module.infer_multi_modal(_txt_feats, _txt_masks, im_feats, im_masks)
+                    score = pl_module.irtr_head(infer["multi_modal_cls_feats"])[:, 0]
 
-            img_batch_score.append(score)
+                img_batch_score.append(score)
 
-        img_batch_score = torch.cat(img_batch_score)
-        rank_scores.append(img_batch_score.cpu().tolist())
-        rank_iids.append(_iid)
+            img_batch_score = torch.cat(img_batch_score)
+            rank_scores.append(img_batch_score)
+            rank_iids.append(_iid)
 
     torch.distributed.barrier()
-    gather_rank_scores = all_gather(rank_scores)
-    gather_rank_iids = all_gather(rank_iids)
+    gather_rank_scores = all_gather_tensor(torch.stack(rank_scores).float())
+    gather_rank_iids = all_gather_tensor(torch.tensor(rank_iids, dtype=torch.long, device=pl_module.device))
 
-    iids = torch.tensor(gather_rank_iids)
+    iids = gather_rank_iids.cpu()
     iids = iids.view(-1)
-    scores = torch.tensor(gather_rank_scores)
+    scores = gather_rank_scores.cpu()
     scores = scores.view(len(iids), -1)
 
-    topk10 = scores.topk(10, dim=1)
-    topk5 = scores.topk(5, dim=1)
-    topk1 = scores.topk(1, dim=1)
-    topk10_iids = tiids[topk10.indices]
-    topk5_iids = tiids[topk5.indices]
-    topk1_iids = tiids[topk1.indices]
+    # topk returns sorted results, so the smaller ks are prefixes of the top-10
+    topk10_indices = scores.topk(10, dim=1).indices
+    topk10_iids = tiids[topk10_indices]
+    topk5_iids = tiids[topk10_indices[:, :5]]
+    topk1_iids = tiids[topk10_indices[:, :1]]
 
     tr_r10 = (iids.unsqueeze(1) == topk10_iids).float().max(dim=1)[0].mean()
     tr_r5 = (iids.unsqueeze(1) == topk5_iids).float().max(dim=1)[0].mean()
     tr_r1 = (iids.unsqueeze(1) == topk1_iids).float().max(dim=1)[0].mean()
 
-    topk10 = scores.topk(10, dim=0)
-    topk5 = scores.topk(5, dim=0)
-    topk1 = scores.topk(1, dim=0)
-    topk10_iids = iids[topk10.indices]
-    topk5_iids = iids[topk5.indices]
-    topk1_iids = iids[topk1.indices]
+    topk10_indices = scores.topk(10, dim=0).indices
+    topk10_iids = iids[topk10_indices]
+    topk5_iids = iids[topk10_indices[:5]]
+    topk1_iids = iids[topk10_indices[:1]]
 
     ir_r10 = (tiids.unsqueeze(0) == topk10_iids).float().max(dim=0)[0].mean()
     ir_r5 = (tiids.unsqueeze(0) == topk5_iids).float().max(dim=0)[0].mean()
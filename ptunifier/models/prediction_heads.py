@@ -105,11 +105,18 @@ class AllGather(torch.autograd.Function):
         output = [torch.empty_like(tensor) for _ in range(world_size)]
         dist.all_gather(output, tensor)
         ctx.rank = rank
+        ctx.world_size = world_size
         ctx.batch_size = tensor.shape[0]
         return torch.cat(output, 0)
 
     @staticmethod
     def backward(ctx, grad_output):
+        # every rank consumes the gathered tensor, so collect the gradients of all ranks before taking the
+        # local slice; average rather than sum so that, after the DDP gradient averaging, the loss keeps the
+        # same gradient scale as a single global loss replicated on every rank
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output)
+        grad_output = grad_output / ctx.world_size
         return (
             grad_output[ctx.batch_size * ctx.rank: ctx.batch_size * (ctx.rank + 1)],
             None,
@@ -137,13 +144,20 @@ class ITCHead(nn.Module):
         image_feats = image_feats / image_feats.norm(dim=1, keepdim=True)
         text_feats = text_feats / text_feats.norm(dim=1, keepdim=True)
 
-        # gather features
-        image_feats_all = allgather(image_feats, torch.distributed.get_rank(), torch.distributed.get_world_size())
-        text_feats_all = allgather(text_feats, torch.distributed.get_rank(), torch.distributed.get_world_size())
-
-        # cosine similarity as logits
-        logits_per_image = image_feats_all @ text_feats_all.t() / self.temp
-        logits_per_text = logits_per_image.t()
+        # gather features: the local samples are contrasted against the negatives of all ranks
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            rank, bs = dist.get_rank(), image_feats.size(0)
+            image_feats_all = allgather(image_feats, rank, dist.get_world_size())
+            text_feats_all = allgather(text_feats, rank, dist.get_world_size())
+            # take the local rows from the gathered tensors so that every gradient goes through AllGather
+            image_feats = image_feats_all[rank * bs: (rank + 1) * bs]
+            text_feats = text_feats_all[rank * bs: (rank + 1) * bs]
+        else:
+            image_feats_all, text_feats_all = image_feats, text_feats
+
+        # cosine similarity as logits, in shape of [local_bs, global_bs]
+        logits_per_image = image_feats @ text_feats_all.t() / self.temp
+        logits_per_text = text_feats @ image_feats_all.t() / self.temp
 
         return logits_per_image, logits_per_text
 
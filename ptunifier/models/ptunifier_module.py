@@ -261,11 +261,7 @@ class PTUnifierTransformerSS(pl.LightningModule):
         if pseudo_language:
             text_masks = torch.ones((uni_modal_text_feats.size(0), uni_modal_text_feats.size(1)),
                                     dtype=torch.long, device=device)
-        extended_text_masks = self.language_encoder.get_extended_attention_mask(text_masks, text_masks.size(), device)
-
-        for layer in self.language_encoder.encoder.layer:
-            uni_modal_text_feats = layer(uni_modal_text_feats, extended_text_masks)[0]
-        uni_modal_text_feats = self.multi_modal_language_proj(uni_modal_text_feats)
+        uni_modal_text_feats, extended_text_masks = self.encode_uni_modal_text(uni_modal_text_feats, text_masks)
         # == End  : Text Encoding ==
 
         # == Begin: Image Encoding ==
@@ -283,27 +279,73 @@ class PTUnifierTransformerSS(pl.LightningModule):
         else:
             uni_modal_image_feats = self.vision_encoder.forward_trans(uni_modal_image_feats)
 
+        uni_modal_image_feats, extended_image_masks = self.encode_uni_modal_image(uni_modal_image_feats,
+                                                                                  image_token_type_idx)
+        # == End  : Image Encoding ==
+
+        # == Begin: Multi-Modal Fusion ==
+        ret.update(self.infer_multi_modal(uni_modal_text_feats, extended_text_masks,
+                                          uni_modal_image_feats, extended_image_masks,
+                                          output_attentions=output_attentions,
+                                          output_layer=self.hparams.config["mim_layer"] if mask_image else None))
+        # == End  : Multi-Modal Fusion ==
+
+        ret.update({
+            "images": img,
+            "patched_images": self.patchify(img) if img is not None and mask_image else None,
+            "text_labels": text_labels,
+            "text_ids": text_ids,
+            "text_masks": text_masks,
+            "extended_image_masks": extended_image_masks,
+            "extended_text_masks": extended_text_masks,
+        })
+
+        return ret
+
+    def encode_uni_modal_text(self, uni_modal_text_feats, text_masks):
+        device = self.device
+        extended_text_masks = self.language_encoder.get_extended_attention_mask(text_masks, text_masks.size(), device)
+
+        for layer in self.language_encoder.encoder.layer:
+            uni_modal_text_feats = layer(uni_modal_text_feats, extended_text_masks)[0]
+        uni_modal_text_feats = self.multi_modal_language_proj(uni_modal_text_feats)
+
+        # Assign Type Embeddings
+        uni_modal_text_feats = uni_modal_text_feats + self.modality_type_embeddings(torch.zeros_like(text_masks))
+        return uni_modal_text_feats, extended_text_masks
+
+    def encode_uni_modal_image(self, uni_modal_image_feats, image_token_type_idx=1):
+        device = self.device
         uni_modal_image_feats = self.multi_modal_vision_proj(uni_modal_image_feats)
         image_masks = torch.ones((uni_modal_image_feats.size(0), uni_modal_image_feats.size(1)),
                                  dtype=torch.long, device=device)
         extended_image_masks = self.language_encoder.get_extended_attention_mask(image_masks, image_masks.size(),
                                                                                  device)
-        # == End  : Image Encoding ==
 
-        # == Begin: Assign Type Embeddings ==
-        uni_modal_text_feats, uni_modal_image_feats = (
-            uni_modal_text_feats + self.modality_type_embeddings(torch.zeros_like(text_masks)),
-            uni_modal_image_feats + self.modality_type_embeddings(torch.full_like(image_masks, image_token_type_idx)),
-        )
-        # == End  : Assign Type Embeddings ==
+        # Assign Type Embeddings
+        uni_modal_image_feats = uni_modal_image_feats + self.modality_type_embeddings(
+            torch.full_like(image_masks, image_token_type_idx))
+        return uni_modal_image_feats, extended_image_masks
 
-        # == Begin: Multi-Modal Fusion ==
+    def infer_uni_modal_text(self, text_ids, text_masks):
+        uni_modal_text_feats = self.language_encoder.embeddings(input_ids=text_ids)
+        return self.encode_uni_modal_text(uni_modal_text_feats, text_masks)
+
+    def infer_uni_modal_image(self, img, image_token_type_idx=1):
+        uni_modal_image_feats = self.vision_encoder.forward_patch_embed(img)
+        uni_modal_image_feats = self.vision_encoder.forward_pos_embed(uni_modal_image_feats)
+        uni_modal_image_feats = self.vision_encoder.forward_trans(uni_modal_image_feats)
+        return self.encode_uni_modal_image(uni_modal_image_feats, image_token_type_idx)
+
+    def infer_multi_modal(self, uni_modal_text_feats, extended_text_masks, uni_modal_image_feats,
+                          extended_image_masks, output_attentions=False, output_layer=None):
+        ret = dict()
         ret["attentions"] = {"text2image_attns": [], "image2text_attns": []} if output_attentions else None
         x, y = uni_modal_text_feats, uni_modal_image_feats
         for layer_idx, (text_layer, image_layer) in enumerate(zip(self.multi_modal_language_layers,
                                                                   self.multi_modal_vision_layers)):
             # == Begin: Fetch the intermediate outputs (different layers to perform MIM) ==
-            if mask_image and self.hparams.config["mim_layer"] == layer_idx:
+            if output_layer == layer_idx:
                 ret[f"multi_modal_text_feats_{layer_idx}"], ret[f"multi_modal_image_feats_{layer_idx}"] = x, y
             # == End  : Fetch the intermediate outputs (different layers to perform MIM) ==
             # == Begin: Co-Attention ==
@@ -316,28 +358,14 @@ class PTUnifierTransformerSS(pl.LightningModule):
                 ret["attentions"]["text2image_attns"].append(x1[1:])
                 ret["attentions"]["image2text_attns"].append(y1[1:])
             # == End  : For visualization: Return the attention weights ==
-        # == End  : Multi-Modal Fusion ==
 
         # == Begin: == Output Multi-Modal Features ==
-        multi_modal_text_feats, multi_modal_image_feats = x, y
         multi_modal_text_cls_feats = self.multi_modal_language_pooler(x)
         multi_modal_image_cls_feats = self.multi_modal_vision_pooler(y)
-        multi_modal_cls_feats = torch.cat([multi_modal_text_cls_feats, multi_modal_image_cls_feats], dim=-1)
+        ret["multi_modal_text_feats"], ret["multi_modal_image_feats"] = x, y
+        ret["multi_modal_cls_feats"] = torch.cat([multi_modal_text_cls_feats, multi_modal_image_cls_feats], dim=-1)
         # == End  : == Output Multi-Modal Features ==
 
-        ret.update({
-            "images": img,
-            "patched_images": self.patchify(img) if img is not None else None,
-            "text_labels": text_labels,
-            "text_ids": text_ids,
-            "text_masks": text_masks,
-            "extended_image_masks": extended_image_masks,
-            "extended_text_masks": extended_text_masks,
-            "multi_modal_text_feats": multi_modal_text_feats,
-            "multi_modal_image_feats": multi_modal_image_feats,
-            "multi_modal_cls_feats": multi_modal_cls_feats,
-        })
-
         return ret
 
     def forward(self, batch, test=False):
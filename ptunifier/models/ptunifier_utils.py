@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from torchmetrics import F1, AUROC, BLEUScore
+from torchmetrics import F1, AUROC, BLEUScore, Metric
 from torchmetrics.text.rouge import ROUGEScore
 from transformers import get_polynomial_decay_schedule_with_warmup, get_cosine_schedule_with_warmup
 from transformers.optimization import AdamW
@@ -96,6 +96,13 @@ def set_metrics(pl_module):
             else:
                 raise ValueError
 
+    # Index the metrics by phase once so that the per-step objectives avoid the attribute lookups
+    pl_module._metrics_by_phase = {"train": dict(), "val": dict(), "test": dict()}
+    for name, module in pl_module._modules.items():
+        phase, _, metric_name = name.partition("_")
+        if phase in pl_module._metrics_by_phase and isinstance(module, Metric):
+            pl_module._metrics_by_phase[phase][metric_name] = module
+
 
 def epoch_wrapup(pl_module, test=False):
     if test:
@@ -179,6 +179,32 @@ def all_gather(data, group=None):
     return data_list
 
 
+def all_gather_tensor(tensor, group=None):
+    """
+    Run all_gather on a tensor that has the same shape on every rank,
+    without going through pickle.
+
+    Args:
+        tensor: a tensor on the device of the communication backend
+        group: a torch process group. By default, the default process group.
+
+    Returns:
+        Tensor: the tensors of all ranks concatenated along the first dimension
+    """
+    if get_world_size() == 1:
+        return tensor
+    tensor = tensor.contiguous()
+    world_size = dist.get_world_size(group=group)
+    if hasattr(dist, "all_gather_into_tensor"):
+        output = torch.empty((world_size * tensor.shape[0],) + tuple(tensor.shape[1:]),
+                             dtype=tensor.dtype, device=tensor.device)
+        dist.all_gather_into_tensor(output, tensor, group=group)
+        return output
+    tensor_list = [torch.empty_like(tensor) for _ in range(world_size)]
+    dist.all_gather(tensor_list, tensor, group=group)
+    return torch.cat(tensor_list, dim=0)
+
+
 def gather(data, dst=0, group=None):
     """
     Run gather on arbitrary picklable data (not necessarily tensors).